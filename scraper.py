@@ -3,15 +3,28 @@
 
 import pandas as pd
 import pprint
-import requests
-from bs4 import BeautifulSoup
+import asyncio
+import aiohttp
+import lxml.html
 import math
 from datetime import datetime
 from selenium import webdriver
+from selenium.common.exceptions import (
+    InvalidArgumentException,
+    InvalidSessionIdException,
+    JavascriptException,
+    TimeoutException,
+    WebDriverException,
+)
 from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 import time
-import json
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import orjson
 import os
+import shelve
 from openpyxl import load_workbook
 import argparse
 
@@ -26,29 +39,22 @@ def load_excel(excelPath, verbose = False):
         verbose (bool, optional): _prints debug message or not_. Defaults to False.
     """
     
-    df = pd.read_excel(excelPath,sheet_name=0)
     print(f"Loading {excelPath}")
+    # Assuming format is consistent. We're only interested in Column F, G, I and K
+    # (library, vulnerabilities, date, url), the second row is the header
+    try:
+        cropped = pd.read_excel(excelPath, sheet_name=0, engine="calamine", usecols="F,G,I,K", header=1)
+    except (ImportError, ValueError):
+        # python-calamine is not installed (or pandas is older than 2.2)
+        cropped = pd.read_excel(excelPath, sheet_name=0, engine="openpyxl", usecols="F,G,I,K", header=1)
     if verbose:
-        print(f"{df.shape[0]} rows, {df.shape[1]}  columns")
+        print(f"{cropped.shape[0]} rows, {cropped.shape[1]}  columns")
     
     # Convert to a list of dictionary to iterate through
-    # Assuming format is consistent. We're interested in Column G - L (7 - 12)
-    cropped = df.iloc[1:, 5:12] # 0 based, first row is header
-
-    libraries = cropped.iloc[:, 0]
-    vulnerabilities = cropped.iloc[:,1]
-    date= cropped.iloc[:, 3]
-    url = cropped.iloc[:, 5]
-
-    dependencies = []
-
-    for i in range(libraries.shape[0]):
-        dependencies.append({
-            "library": libraries.iloc[i],
-            "vulnerabilities": vulnerabilities.iloc[i],
-            "date": date.iloc[i],
-            "url": url.iloc[i]
-        })
+    dependencies = [
+        {"library": row[0], "vulnerabilities": row[1], "date": row[2], "url": row[3]}
+        for row in cropped.to_numpy(dtype=object)
+    ]
     if verbose:
         print(f"Here are the first few libraries:")
         pprint.pprint(dependencies[:5])
@@ -57,7 +63,233 @@ def load_excel(excelPath, verbose = False):
 
 
 
-def scrape_data(dependencies, verbose):
+EMPTY_ROW = {
+    "Version" : "",
+    "Vulnerabilities" : "",
+    "Date" : ""
+}
+SELENIUM_WORKERS = 4
+RETRIES = 3 # attempts per url, waiting 1s, 2s, ... in between
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".scrape_cache")
+CACHE_TTL = 7 * 24 * 60 * 60 # seconds
+VERSIONS_TABLE_SCRIPT = """
+var table = document.querySelector('table.versions');
+var headers = Array.from(table.querySelectorAll('thead th'), function (th) { return th.innerText; });
+var cells = Array.from(table.querySelector('tbody tr').querySelectorAll('td'), function (td) { return td.innerText; });
+return [headers, cells];
+"""
+FIRST_ROW_READY_SCRIPT = """
+return document.readyState !== 'loading' && document.querySelector('table.versions tbody tr') !== null;
+"""
+HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36"}
+
+
+def parse_versions_table(html):
+    """
+    Extract the first row of the "versions" table from a page's html.
+
+    Args:
+        html (str): Raw html of the library page.
+
+    Returns:
+        dict: The cells of the first row, keyed by the table headers.
+    """
+    tree = lxml.html.fromstring(html)
+    table = tree.xpath('//table[contains(concat(" ", normalize-space(@class), " "), " versions ")]')[0]
+    headers = [" ".join(th.text_content().split()) for th in table.xpath('./thead/tr/th')]
+    cells = [" ".join(td.text_content().split()) for td in table.xpath('./tbody/tr[1]/td')]
+    return dict(zip(headers, cells))
+
+
+async def fetch(session, url, verbose, on_row=None):
+    for attempt in range(RETRIES):
+        try:
+            if verbose:
+                print(f"scraping: {url}")
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                response.raise_for_status()
+                html = await response.text()
+            rowData = parse_versions_table(html)
+            break
+        except aiohttp.ClientResponseError as e:
+            # only rate limiting and server errors are worth retrying
+            if (e.status != 429 and e.status < 500) or attempt == RETRIES - 1:
+                raise
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+            if attempt == RETRIES - 1:
+                raise
+        await asyncio.sleep(2 ** attempt)
+    if on_row:
+        on_row(url, rowData)
+    return rowData
+
+
+async def scrape_data_async(urls, verbose, on_row=None):
+    """
+    Fetch all urls concurrently over a single http session. If given, on_row(url, row)
+    is called as soon as each url is scraped successfully.
+
+    Returns:
+        list: For each url, either the scraped row or the exception raised.
+    """
+    connector = aiohttp.TCPConnector(limit=32)
+    async with aiohttp.ClientSession(connector=connector, headers=HEADERS) as session:
+        tasks = [fetch(session, url, verbose, on_row) for url in urls]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def chrome_options():
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless=new")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--no-sandbox")
+    # The versions table is plain text, don't download anything else
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    options.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.managed_default_content_settings.stylesheets": 2,
+        "profile.default_content_setting_values.notifications": 2,
+    })
+    # Don't wait for the page to finish loading, scrape_row_selenium waits for the table itself
+    options.page_load_strategy = "none"
+    return options
+
+
+def scrape_row_selenium(driver, url):
+    # With page_load_strategy "none", get() returns before the new document replaces
+    # the previous url's page, so wait for the old page to go away first
+    old_page = driver.find_element(By.TAG_NAME, "html")
+    driver.get(url)
+    wait = WebDriverWait(driver, 15)
+    wait.until(EC.staleness_of(old_page))
+    wait.until(lambda d: d.execute_script(FIRST_ROW_READY_SCRIPT))
+
+    # Read the headers and the first row of the "versions" table in a single
+    # round trip to the browser instead of one per element
+    headers, cells = driver.execute_script(VERSIONS_TABLE_SCRIPT)
+    return dict(zip((h.strip() for h in headers), (c.strip() for c in cells)))
+
+
+def scrape_data_selenium(urls, verbose, workers=SELENIUM_WORKERS, on_row=None):
+    """
+    Scrape the urls with Chrome, for pages that only render the table with javascript.
+    A pool of browsers is shared by a thread pool so page loads overlap; a browser is
+    only restarted if its session is lost. If given, on_row(url, row) is called on the
+    calling thread as soon as each url is scraped successfully.
+
+    Returns:
+        list: For each url, either the scraped row or the exception raised.
+    """
+    if not urls:
+        return []
+    drivers = queue.Queue()
+    for _ in range(min(workers, len(urls))):
+        drivers.put(webdriver.Chrome(options=chrome_options()))
+
+    def worker(url):
+        driver = drivers.get()
+        start_time = time.perf_counter()
+        try:
+            for attempt in range(RETRIES):
+                try:
+                    if verbose:
+                        print(f"scraping: {url}")
+                    return scrape_row_selenium(driver, url)
+                except (TimeoutException, JavascriptException, InvalidArgumentException) as e:
+                    # no versions table showed up or not a valid url, retrying won't help
+                    return e
+                except WebDriverException as e:
+                    if isinstance(e, InvalidSessionIdException) or driver.session_id is None:
+                        # the browser crashed or was closed, start a fresh one
+                        driver.quit()
+                        driver = webdriver.Chrome(options=chrome_options())
+                    if attempt == RETRIES - 1:
+                        return e
+                    time.sleep(2 ** attempt)
+                except Exception as e:
+                    return e
+        finally:
+            drivers.put(driver)
+            if verbose:
+                print(f"Elapsed time: {time.perf_counter() - start_time} seconds ({url})")
+
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=drivers.qsize()) as executor:
+            futures = {executor.submit(worker, url): url for url in urls}
+            # Hand rows to on_row from this thread, the cache behind it may not be
+            # usable from the worker threads
+            for future in as_completed(futures):
+                url = futures[future]
+                results[url] = future.result()
+                if on_row and not isinstance(results[url], BaseException):
+                    on_row(url, results[url])
+    finally:
+        while not drivers.empty():
+            drivers.get().quit()
+    return [results[url] for url in urls]
+
+
+def scrape_data_playwright(urls, verbose, on_row=None):
+    """
+    Scrape the urls with a single Playwright chromium process. Unlike selenium, a page
+    is read as soon as the versions table is in the DOM instead of waiting for the full
+    page load. If given, on_row(url, row) is called as soon as each url is scraped
+    successfully.
+
+    Returns:
+        list: For each url, either the scraped row or the exception raised.
+    """
+    # Optional dependency, only needed for this backend
+    from playwright.sync_api import sync_playwright, Error as PlaywrightError
+
+    def block_resources(route):
+        if route.request.resource_type in ("image", "stylesheet", "font", "media"):
+            route.abort()
+        else:
+            route.continue_()
+
+    rows = []
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True, args=["--single-process"])
+        context = browser.new_context(user_agent=HEADERS["User-Agent"])
+        context.route("**/*", block_resources)
+        page = context.new_page()
+        for url in urls:
+            start_time = time.perf_counter()
+            if not url.startswith(("http://", "https://")):
+                # labels like section names in the url column, retrying won't help
+                rows.append(ValueError(f"not an http url: {url}"))
+                continue
+            for attempt in range(RETRIES):
+                try:
+                    if verbose:
+                        print(f"scraping: {url}")
+                    page.goto(url, wait_until="domcontentloaded")
+                except PlaywrightError as e:
+                    # navigation errors and timeouts, try again after a pause
+                    rowData = e
+                    if attempt < RETRIES - 1:
+                        time.sleep(2 ** attempt)
+                    continue
+                try:
+                    # javascript may still be building the table after domcontentloaded
+                    page.wait_for_selector("table.versions tbody tr", timeout=15000)
+                    rowData = parse_versions_table(page.content())
+                except Exception as e:
+                    # no versions table showed up, retrying won't help
+                    rowData = e
+                break
+            rows.append(rowData)
+            if on_row and not isinstance(rowData, BaseException):
+                on_row(url, rowData)
+            if verbose:
+                print(f"Elapsed time: {time.perf_counter() - start_time} seconds")
+        browser.close()
+    return rows
+
+
+def scrape_data(dependencies, verbose, backend="http", use_cache=True):
     """
     Scrape the first row of the "versions" table from the given list of dependencies.
     The scraped data is then formatted and put into the same list of dictionaries.
@@ -66,90 +298,74 @@ def scrape_data(dependencies, verbose):
         dependencies (list): A list of dictionaries containing library name, url, 
             and other information.
         verbose (bool): Whether to print debug message or not.
+        backend (str, optional): "http" fetches the raw html concurrently, "selenium"
+            renders each page in Chrome, "playwright" renders them in one headless
+            chromium. Defaults to "http".
+        use_cache (bool, optional): Whether to reuse rows cached by a previous run
+            within CACHE_TTL. Freshly scraped rows are cached either way. Defaults to True.
 
     Returns:
         list: The list of dictionaries with scraped data.
     """
     first_rows_of_version_table = []
     failed_url = {}
+    urls = [dep["url"] for dep in dependencies]
+    # Libraries often share a project page, only fetch each url once
+    unique_urls = list(dict.fromkeys(url for url in urls if isinstance(url, str) and url))
     
-    print(f"Start scrapping {len(dependencies)} libraries.")
-    for i, dep in enumerate(dependencies[:]):
+    print(f"Start scrapping {len(dependencies)} libraries ({len(unique_urls)} unique urls).")
+    start_time = time.perf_counter()
+    with shelve.open(CACHE_PATH) as cache:
+        # Reuse rows scraped by a recent run, keyed by url
+        results = {}
+        now = time.time()
+        if use_cache:
+            for url in unique_urls:
+                cached = cache.get(url)
+                if cached and now - cached["ts"] < CACHE_TTL:
+                    results[url] = cached["row"]
         if verbose:
-            print(f"================== {i + 1} / {len(dependencies)} ==================")
-        driver = webdriver.Chrome()
-        url = dep["url"]
-        start_time = time.perf_counter()
-        try:
-            if verbose:
-                print(f"scraping: {url}")
-            driver.get(url)
-
-            # Find the first row of the "versions" table
-            table = driver.find_element(By.CLASS_NAME, 'versions')
-            thead = table.find_element(By.TAG_NAME, 'thead')
-            tr = thead.find_element(By.TAG_NAME, "tr")
-            ths = tr.find_elements(By.TAG_NAME, "th")
-            
-            headers= []
-            for th in ths:
-                headers.append(th.text)
-            
-            tbody = table.find_element(By.TAG_NAME, 'tbody')
-            first_row = tbody.find_element(By.TAG_NAME, 'tr')
-            cells = first_row.find_elements(By.TAG_NAME, 'td')
-
-            # Extract the data from the first row
-            rowData = {}
-            for i, cell in enumerate(cells):
-                try:
-                    x = cell.text
-                except:
-                    x = ""
-                rowData[headers[i]] =  x
-            
-            
-        except Exception as e:
+            print(f"{len(results)} urls loaded from cache.")
+
+        # Cache each row as soon as it is scraped, so an interrupted run keeps its progress.
+        # The backends call this on the thread that opened the shelf
+        def save_row(url, rowData):
+            try:
+                cache[url] = {"row": rowData, "ts": time.time()}
+            except Exception as e:
+                # a broken cache shouldn't fail a url that scraped fine
+                print(f"Could not cache {url}: {e}")
+
+        urls_to_fetch = [url for url in unique_urls if url not in results]
+        if backend == "selenium":
+            rows = scrape_data_selenium(urls_to_fetch, verbose, on_row=save_row)
+        elif backend == "playwright":
+            rows = scrape_data_playwright(urls_to_fetch, verbose, on_row=save_row)
+        else:
+            rows = asyncio.run(scrape_data_async(urls_to_fetch, verbose, on_row=save_row))
+        results.update(zip(urls_to_fetch, rows))
+
+    for i, url in enumerate(urls):
+        rowData = results.get(url)
+        if rowData is None or isinstance(rowData, BaseException):
             # invalid url
             if verbose:
                 print(f"Encountered error, pay attention to this url: {url}")
-            rowData = {
-                "Version" : "",
-                "Vulnerabilities" : "",
-                "Date" : ""
-            }
-            
+            rowData = dict(EMPTY_ROW)
             failed_url[i] = url
-        finally:
-            driver.close()
-            # pass
-
-
-        end_time = time.perf_counter()
-        elapsed_time = end_time - start_time
         first_rows_of_version_table.append(rowData)
-        if verbose:
-            print(f"Elapsed time: {elapsed_time} seconds")
-    
-    driver.quit()
-    
-    print(f"Finished scrapping {len(dependencies)} libraries.")
+
+    elapsed_time = time.perf_counter() - start_time
+    print(f"Finished scrapping {len(dependencies)} libraries in {elapsed_time:.1f} seconds.")
     print(f"{len(failed_url)} urls failed during fetching:")
     print(failed_url)
-    # Format the scraped data
-    for i in range(len(dependencies[:])):
-        row = first_rows_of_version_table[i]
-        versionNumber = row["Version"]
-        dateString = row["Date"]
-        vulnerabilitiesString = row["Vulnerabilities"]
-        
-        formatedVersion = formatLibrary(dependencies[i]["library"], versionNumber)
-        formatedVulnerability = formatVulnerability(vulnerabilitiesString)
-        formatedDate = formatDate(dateString)
-        
-        dependencies[i]['date']= formatedDate
-        dependencies[i]['library']= formatedVersion
-        dependencies[i]['vulnerabilities']= formatedVulnerability
+    # Format the scraped data in a single pass over the whole table
+    scraped = pd.DataFrame(first_rows_of_version_table, columns=["Version", "Vulnerabilities", "Date"])
+    df = pd.DataFrame(dependencies, columns=["library", "vulnerabilities", "date", "url"])
+    df["library"] = formatLibraries(df["library"], scraped["Version"])
+    df["vulnerabilities"] = formatVulnerabilities(scraped["Vulnerabilities"])
+    df["date"] = formatDates(scraped["Date"])
+    dependencies = df.to_dict("records")
 
     print("Dependencies formatted.")
     if verbose:
@@ -159,41 +375,39 @@ def scrape_data(dependencies, verbose):
     return dependencies
 
 
-def formatLibrary(libName, versionNumber):
-    if (not libName or (type(libName) is float and math.isnan(libName))):
-        return math.nan
-    libNameList =libName.split('-')
-    extension = libNameList[-1].split('.')[-1]
-    return "".join(libNameList[:-1]) + "-" + versionNumber + "." + extension
+def formatLibraries(libNames, versionNumbers):
+    """ Replace the version in each "<name>-<version>.<ext>" library name, NaN when empty. """
+    libNames = pd.Series(libNames, dtype=object)
+    parts = libNames.str.rsplit("-", n=1)
+    name = parts.str[0].str.replace("-", "", regex=False).where(parts.str.len() > 1, "")
+    extension = parts.str[-1].str.rsplit(".", n=1).str[-1]
+    formatted = name + "-" + pd.Series(versionNumbers, dtype=object) + "." + extension
+    return formatted.where(libNames.str.len() > 0, math.nan)
 
-def formatVulnerability(vulnerabilitiesString):
-    if (not vulnerabilitiesString or (type(vulnerabilitiesString) is float and math.isnan(vulnerabilitiesString))):
-        return math.nan
-    return vulnerabilitiesString.split()[0]
+def formatVulnerabilities(vulnerabilitiesStrings):
+    """ Keep only the count of each "<n> vulnerabilities" string, NaN when empty. """
+    return pd.Series(vulnerabilitiesStrings, dtype=object).str.split(n=1).str[0]
 
-def formatDate(dateString):
-    if (not dateString or (type(dateString) is float and math.isnan(dateString))):
-        return math.nan
-    date_format = "%b %d, %Y"
-    return datetime.strptime(dateString, date_format)
+def formatDates(dateStrings):
+    """ Parse all "Jul 17, 2006" style dates in one pass, NaN when empty or invalid. """
+    dates = pd.to_datetime(pd.Index(dateStrings, dtype=object), format="%b %d, %Y", errors="coerce")
+    return pd.Series([math.nan if date is pd.NaT else date for date in dates.to_pydatetime()], dtype=object)
 
 
 def write_json(dependencies, verbose):
     formatted_date = datetime.now().strftime('%Y%m%d')
     filename = f'{formatted_date}_dependencies.json'
 
-    dep_copy = dependencies[:]
-    for dep in dep_copy:
-        for k, value in dep.items():
-            if isinstance(value, float) and math.isnan(value):
-                dep[k] = ""
-            if isinstance(value, datetime):
-                dep[k] = value.isoformat()
-
-
-    # Writing the dictionary to a JSON file
-    with open(filename, 'w') as file:
-        json.dump(dep_copy, file, indent=4, ensure_ascii=False,)
+    # Writing the dictionaries to a JSON file one at a time, blanking NaN on the way
+    # instead of copying the whole list. orjson writes datetimes as iso strings
+    with open(filename, 'wb') as file:
+        file.write(b"[")
+        for i, dep in enumerate(dependencies):
+            record = {k: "" if isinstance(v, float) and math.isnan(v) else v for k, v in dep.items()}
+            encoded = orjson.dumps(record, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY)
+            file.write(b",\n  " if i else b"\n  ")
+            file.write(encoded.replace(b"\n", b"\n  "))
+        file.write(b"\n]" if dependencies else b"]")
     print(f"Saved {filename} to {filename}.")
 
 
@@ -209,24 +423,38 @@ def write_excel(dependencies, excelPath, verbose):
 
     workbook._sheets.insert(0, workbook._sheets.pop(workbook.sheetnames.index(new_sheet.title)))
 
-    # Save the workbook
-    workbook.save(excelPath)
     if verbose:
-        print(f"Duplicated '{sheet_to_duplicate.title}' as '{new_sheet.title}' in '{excelPath}'")
-
-    # Write data rows
-    for row_idx, row_data in enumerate(dependencies, start=3):
-        new_sheet.cell(row=row_idx, column=6, value=row_data.get('library'))
-        new_sheet.cell(row=row_idx, column=7, value=row_data.get('vulnerabilities'))
-        new_sheet.cell(row=row_idx, column=9, value=row_data.get('date'))
+        print(f"Duplicated '{sheet_to_duplicate.title}' as '{new_sheet.title}'")
+
+    # Write data rows. The copied sheet already holds most of these cells, so
+    # only touch the ones whose value changed and only create the missing ones
+    # Keep the sheet's existing format: empty cells for NaN, dates as iso strings
+    def blank(value):
+        if isinstance(value, float) and math.isnan(value):
+            return None
+        if isinstance(value, datetime):
+            return value.isoformat()
+        return value
+    rows_data = [(blank(d.get('library')), blank(d.get('vulnerabilities')), blank(d.get('date'))) for d in dependencies]
+    cells = new_sheet._cells
+    for row_idx, row_data in enumerate(rows_data, start=3):
+        for column, value in zip((6, 7, 9), row_data):
+            cell = cells.get((row_idx, column))
+            if cell is None:
+                if value is None:
+                    continue
+                cell = new_sheet.cell(row=row_idx, column=column)
+            elif cell.value == value:
+                continue
+            cell.value = value
     workbook.save(excelPath)
     print(f"Saved '{new_sheet.title}' to '{excelPath}'")
 
 
-def run(excelPath, verbose):
+def run(excelPath, verbose, backend="http", use_cache=True):
     print("Starting program...")
     dependencies = load_excel(excelPath, verbose)
-    dependencies = scrape_data(dependencies, verbose)
+    dependencies = scrape_data(dependencies, verbose, backend, use_cache)
     write_json(dependencies, verbose)
     write_excel(dependencies, excelPath, verbose)
     print("Program completed.")
@@ -238,8 +466,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Updates the excel file with the latest dependencies.")
     parser.add_argument("excel_path", type=str, help="Path to the excel file")
     parser.add_argument('-v', '--verbose', action='store_true', help="If true, prints out all messages. Else, prints out minimal messages and a progress bar.") 
+    parser.add_argument('-b', '--backend', choices=["http", "selenium", "playwright"], default="http", help="How pages are fetched. Use selenium or playwright if the versions table is rendered by javascript.")
+    parser.add_argument('--no-cache', action='store_true', help="Ignore rows cached by previous runs and scrape every url again.")
     
     args = parser.parse_args()
     excel_path = args.excel_path
     verbose = args.verbose
-    run(excel_path, verbose)
+    run(excel_path, verbose, args.backend, not args.no_cache)